@@ -1,14 +1,28 @@
 import os
+import re
+import string
+import time
 import logging
 import asyncio
+import functools
+import itertools
+from concurrent.futures import ThreadPoolExecutor
 import gspread
+from aiolimiter import AsyncLimiter
+from google.auth.transport.requests import Request
+from google.oauth2.service_account import Credentials
 from aiogram import Bot, Dispatcher, Router, F, types
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.fsm.storage.redis import RedisStorage
 from aiogram.types import KeyboardButton, ReplyKeyboardMarkup
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 from dotenv import load_dotenv
+from redis.asyncio import Redis
+from tenacity import before_sleep_log, retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 import jdatetime
 from datetime import datetime
 
@@ -16,6 +30,8 @@ from datetime import datetime
 import zoneinfo
 
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.enums import ParseMode
 
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,15 +39,48 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 SPREADSHEET_ID = os.getenv("SPREADSHEET_ID")
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+WEBAPP_HOST = os.getenv("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.getenv("WEBAPP_PORT", "8080"))
 CREDENTIALS_FILE = 'starry-center-456009-a7-90082ba64a87.json' 
 HOURLY_RATE = 70000
+JALALI_FRIDAY = 6
+TEHRAN_TZ = zoneinfo.ZoneInfo("Asia/Tehran")
+DATE_RE = re.compile(r'(\d+)/(\d+)/(\d+)')
+DURATION_RE = re.compile(r'(\d+):(\d+)')
+CLOCK_TIME_RE = re.compile(r'(\d{1,2}):(\d{2}):(\d{2}) ([AP]M)')
+STATS_MESSAGE_TEMPLATE = string.Template(
+    "📊 *stats of $month*\n\n"
+    "🕒 *total hours:* `$total_hours`\n"
+    "💵 *current salary:* `$current_salary TMN`\n\n"
+    "📈 *expected salary (8 hours a day):* `$expected_salary TMN`\n"
+    "🔮 *projected salary:* `$projected_salary TMN`"
+)
+PERSIAN_WEEKDAYS = ("شنبه", "یکشنبه", "دوشنبه", "سه‌شنبه", "چهارشنبه", "پنج‌شنبه", "جمعه")
+SHEET_CACHE_TTL = 60
+ACTIVITY_TIMEOUT = 15 * 60
+# column B (weekday) is never read back, so the cache skips it
+SHEET_CACHE_RANGES = ['A2:A', 'C2:E']
+SHEETS_CONCURRENCY = 5
+THREAD_POOL_WORKERS = 32
+SHEETS_RETRY_ATTEMPTS = 5
+RETRYABLE_STATUS_CODES = {429, 503}
+# a 503 may arrive after Google applied the request, so non-idempotent calls only retry rate limits
+NON_IDEMPOTENT_RETRYABLE_STATUS_CODES = {429}
+CREDENTIALS_REFRESH_INTERVAL = 50 * 60
 
 if not BOT_TOKEN or not SPREADSHEET_ID:
     raise ValueError("BOT_TOKEN and SPREADSHEET_ID must be set in the .env file.")
 
 
 try:
-    gc = gspread.service_account(filename=CREDENTIALS_FILE)
+    credentials = Credentials.from_service_account_file(CREDENTIALS_FILE, scopes=gspread.auth.DEFAULT_SCOPES)
+    gc = gspread.authorize(credentials)
+    # open_by_key() and .sheet1 fetch the spreadsheet metadata once here, not on the first write
     worksheet = gc.open_by_key(SPREADSHEET_ID).sheet1
     logging.info("Successfully connected to Google Sheets.")
 except Exception as e:
@@ -39,26 +88,166 @@ except Exception as e:
     exit()
 
 
+sheets_semaphore = asyncio.Semaphore(SHEETS_CONCURRENCY)
+sheets_limiter = AsyncLimiter(max_rate=60, time_period=60)
+tg_limiter = AsyncLimiter(max_rate=25, time_period=1)
+
+def sheet_retry(status_codes):
+    """Builds a retry decorator for Sheets API errors with one of the given status codes."""
+    return retry(
+        retry=retry_if_exception(
+            lambda exc: isinstance(exc, gspread.exceptions.APIError) and exc.response.status_code in status_codes
+        ),
+        wait=wait_random_exponential(multiplier=0.5, max=8),
+        stop=stop_after_attempt(SHEETS_RETRY_ATTEMPTS),
+        before_sleep=before_sleep_log(logging.getLogger(), logging.WARNING),
+        reraise=True,
+    )
+
+async def run_sheet_call(fn, *args, **kwargs):
+    """Runs a blocking gspread call in a worker thread under the Sheets rate limits."""
+    async with sheets_limiter, sheets_semaphore:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+@sheet_retry(RETRYABLE_STATUS_CODES)
+async def sheet_call(fn, *args, **kwargs):
+    """Runs an idempotent gspread call, retrying on rate-limit and unavailable responses."""
+    return await run_sheet_call(fn, *args, **kwargs)
+
+@sheet_retry(NON_IDEMPOTENT_RETRYABLE_STATUS_CODES)
+async def non_idempotent_sheet_call(fn, *args, **kwargs):
+    """Runs a gspread call that must not be repeated (such as an append), retrying on rate limits only."""
+    return await run_sheet_call(fn, *args, **kwargs)
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    """Holds every outgoing Bot API request until the limiter lets it through."""
+
+    def __init__(self, limiter):
+        self.limiter = limiter
+
+    async def __call__(self, make_request, bot, method):
+        async with self.limiter:
+            return await make_request(bot, method)
+
+
+class SheetCache:
+    """Keeps an in-memory copy of the data rows (columns A:E, starting at row 2, with B left blank)."""
+
+    first_row = 2
+
+    def __init__(self, sheet, ttl=SHEET_CACHE_TTL):
+        self.sheet = sheet
+        self.ttl = ttl
+        self.rows = []
+        self.last_fetch = 0.0
+        self.dirty = True
+        self.writes = 0
+        self.lock = asyncio.Lock()
+        self.open_checkin_row = None
+        self.month_rows = {}
+
+    async def get_rows(self, force=False):
+        """Returns the cached rows, fetching them again when dirty or older than the TTL."""
+        async with self.lock:
+            if force or self.dirty or time.monotonic() - self.last_fetch >= self.ttl:
+                writes_before_fetch = self.writes
+                dates, times = await sheet_call(
+                    self.sheet.batch_get, SHEET_CACHE_RANGES, value_render_option='UNFORMATTED_VALUE'
+                )
+                self.rows = [
+                    [date_row[0] if date_row else '', ''] + time_row
+                    for date_row, time_row in itertools.zip_longest(dates, times, fillvalue=[])
+                ]
+                self.month_rows = {}
+                for index in range(len(self.rows)):
+                    self.index_row(index)
+                self.last_fetch = time.monotonic()
+                # a write that landed while the fetch was in flight may be missing from the result
+                self.dirty = self.writes != writes_before_fetch
+            return self.rows
+
+    async def get_month_rows(self, year, month):
+        """Returns the cached rows dated in the given Jalali month."""
+        await self.get_rows()
+        return [self.rows[index] for index in self.month_rows.get((year, month), [])]
+
+    def index_row(self, index):
+        """Files a cached row under the (year, month) of its date in month_rows."""
+        date = self.rows[index][0] if self.rows[index] else ''
+        if not isinstance(date, str):
+            return
+        try:
+            year, month, _ = parse_jalali_date(date)
+        except ValueError:
+            return
+        indexes = self.month_rows.setdefault((year, month), [])
+        if index not in indexes:
+            indexes.append(index)
+
+    def invalidate(self):
+        """Marks the cached rows as stale so the next read goes to Google Sheets."""
+        self.writes += 1
+        self.dirty = True
+
+    def set_cells(self, row, first_col, values):
+        """Copies values just written to the sheet into the cached row, starting at first_col."""
+        self.writes += 1
+        if self.dirty:
+            return
+        index = row - self.first_row
+        while len(self.rows) <= index:
+            self.rows.append([])
+        record = self.rows[index]
+        last_col = first_col + len(values) - 1
+        while len(record) < last_col:
+            record.append('')
+        record[first_col - 1:last_col] = values
+        if first_col == 1:
+            self.index_row(index)
+
+
+sheet_cache = SheetCache(worksheet)
+
+
+def gregorian_to_jalali(gy, gm, gd):
+    """Converts a Gregorian date to a (year, month, day) Jalali tuple using integer arithmetic only."""
+    days_before_month = (0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334)
+    gy2 = gy + 1 if gm > 2 else gy
+    days = (
+        355666 + 365 * gy + (gy2 + 3) // 4 - (gy2 + 99) // 100 + (gy2 + 399) // 400
+        + gd + days_before_month[gm - 1]
+    )
+    jy = -1595 + 33 * (days // 12053)
+    days %= 12053
+    jy += 4 * (days // 1461)
+    days %= 1461
+    if days > 365:
+        jy += (days - 1) // 365
+        days = (days - 1) % 365
+    if days < 186:
+        return jy, 1 + days // 31, 1 + days % 31
+    return jy, 7 + (days - 186) // 30, 1 + (days - 186) % 30
 
 def get_current_jalali_datetime():
     """Returns current Jalali date, Tehran time, and Persian weekday."""
     
-    tehran_tz = zoneinfo.ZoneInfo("Asia/Tehran")
-    now_gregorian = datetime.now(tehran_tz)
+    now_gregorian = datetime.now(TEHRAN_TZ)
     
     
-    j_now = jdatetime.datetime.fromgregorian(datetime=now_gregorian)
-    date_str = j_now.strftime('%Y/%m/%d')
-    time_str = now_gregorian.strftime("%I:%M:%S %p")
+    jy, jm, jd = gregorian_to_jalali(now_gregorian.year, now_gregorian.month, now_gregorian.day)
+    date_str = f"{jy:04d}/{jm:02d}/{jd:02d}"
+    hour_12 = now_gregorian.hour % 12 or 12
+    am_pm = "AM" if now_gregorian.hour < 12 else "PM"
+    time_str = f"{hour_12:02d}:{now_gregorian.minute:02d}:{now_gregorian.second:02d} {am_pm}"
     
     
     
-    persian_weekday_map = ["شنبه", "یکشنبه", "دوشنبه", "سه‌شنبه", "چهارشنبه", "پنج‌شنبه", "جمعه"]
-    jalali_weekday_index = j_now.weekday()
-    weekday_str = persian_weekday_map[jalali_weekday_index]
+    # the Persian week starts on Saturday, which is 5 in Python's Monday-based weekday()
+    weekday_str = PERSIAN_WEEKDAYS[(now_gregorian.weekday() + 2) % 7]
     
     return date_str, time_str, weekday_str
 
+@functools.lru_cache(maxsize=256)
 def get_last_day_of_jalali_month(year, month):
     """Calculates the number of days in a given Jalali month."""
     if 1 <= month <= 6:
@@ -69,57 +258,117 @@ def get_last_day_of_jalali_month(year, month):
         return 29 if not jdatetime.date(year, 1, 1).isleap() else 30
     return 0
 
-def find_first_empty_row(sheet):
-    """Finds the first empty row in column A, starting from row 2."""
-    all_dates = sheet.col_values(1)
-    for i, date in enumerate(all_dates[1:], start=2):
-        if not date:
-            return i
-    return len(all_dates) + 1
-
-def calculate_monthly_stats(sheet, j_now, hourly_rate):
-    """Calculates comprehensive monthly stats from the sheet."""
-    all_records = sheet.get_all_values()
+@functools.lru_cache(maxsize=64)
+def get_first_weekday_of_jalali_month(year, month):
+    """Returns the Jalali weekday index (Saturday = 0) of the first day of a month."""
+    return jdatetime.date(year, month, 1).weekday()
+
+def count_business_days_until(year, month, day):
+    """Returns the number of non-Friday days from day 1 to the given day of a Jalali month."""
+    first_weekday = get_first_weekday_of_jalali_month(year, month)
+    fridays = (day + first_weekday + 6 - JALALI_FRIDAY) // 7
+    return day - fridays
+
+def count_business_days_in_jalali_month(year, month):
+    """Returns the number of non-Friday days in a Jalali month."""
+    return count_business_days_until(year, month, get_last_day_of_jalali_month(year, month))
+
+def is_fixed_width_date(date_str):
+    """Checks whether a string has the YYYY/MM/DD shape written by the bot."""
+    return len(date_str) == 10 and date_str[4] == '/' and date_str[7] == '/'
+
+def parse_jalali_date(date_str):
+    """Parses a YYYY/MM/DD date into (year, month, day) integers."""
+    if is_fixed_width_date(date_str):
+        return int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10])
+    match = DATE_RE.fullmatch(date_str)
+    if not match:
+        raise ValueError(f"Not a YYYY/MM/DD date: {date_str!r}")
+    year, month, day = map(int, match.groups())
+    return year, month, day
+
+def parse_duration_minutes(duration_str):
+    """Parses an HH:MM[:SS] duration into whole minutes."""
+    if len(duration_str) >= 5 and duration_str[2] == ':':
+        return int(duration_str[0:2]) * 60 + int(duration_str[3:5])
+    match = DURATION_RE.match(duration_str)
+    if not match:
+        raise ValueError(f"Not an HH:MM duration: {duration_str!r}")
+    hours, minutes = match.groups()
+    return int(hours) * 60 + int(minutes)
+
+def parse_clock_time_seconds(time_str):
+    """Parses an HH:MM:SS AM/PM time or a day-fraction cell into seconds since midnight, or None."""
+    if isinstance(time_str, (int, float)):
+        return round(time_str * 86400) % 86400
+    match = CLOCK_TIME_RE.fullmatch(time_str) if isinstance(time_str, str) else None
+    if not match:
+        return None
+    hours, minutes, seconds, am_pm = match.groups()
+    hours = int(hours) % 12 + (12 if am_pm == 'PM' else 0)
+    return hours * 3600 + int(minutes) * 60 + int(seconds)
+
+def format_session_duration(checkin_time, checkout_time):
+    """Returns the HH:MM duration between two clock times (across midnight if needed), or None."""
+    checkin_seconds = parse_clock_time_seconds(checkin_time)
+    checkout_seconds = parse_clock_time_seconds(checkout_time)
+    if checkin_seconds is None or checkout_seconds is None:
+        return None
+    total_minutes = (checkout_seconds - checkin_seconds) % 86400 // 60
+    return f"{total_minutes // 60:02d}:{total_minutes % 60:02d}"
+
+def get_duration_minutes(value):
+    """Returns whole minutes from a duration cell, either a day fraction or HH:MM text."""
+    if isinstance(value, (int, float)):
+        return round(value * 24 * 60)
+    return parse_duration_minutes(value)
+
+def get_first_row_of_range(a1_range):
+    """Returns the first row number of an A1 range such as "Sheet1!A42:C42"."""
+    start_cell = a1_range.rsplit('!', 1)[-1].split(':')[0]
+    row, _ = gspread.utils.a1_to_rowcol(start_cell)
+    return row
+
+def find_open_row(rows):
+    """Finds the last cached row with a check-in time but no check-out time."""
+    for i in range(len(rows) - 1, -1, -1):
+        row = rows[i]
+        # a check-out at exactly midnight reads back as 0, so only an empty cell counts as open
+        if len(row) > 2 and row[2] and (len(row) < 4 or row[3] == ''):
+            return i + SheetCache.first_row
+    return None
+
+def calculate_monthly_stats(records, j_now, hourly_rate):
+    """Calculates comprehensive monthly stats from the current month's data rows."""
     total_minutes = 0
-    worked_days = set()
+    worked_days_mask = 0
     current_jmonth = j_now.month
     current_jyear = j_now.year
     current_jday = j_now.day
 
-    for record in all_records[1:]:
-        if len(record) >= 5 and record[0] and record[4]:
-            try:
-                date_parts = record[0].split('/')
-                record_year, record_month, record_day = map(int, date_parts)
-                if record_year == current_jyear and record_month == current_jmonth:
-                    worked_days.add(record_day)
-                    time_parts = record[4].split(':')
-                    if len(time_parts) >= 2:
-                        total_minutes += int(time_parts[0]) * 60 + int(time_parts[1])
-            except (ValueError, IndexError):
-                continue
+    for record in records:
+        if len(record) < 5 or record[4] == '':
+            continue
+        try:
+            _, _, record_day = parse_jalali_date(record[0])
+            worked_days_mask |= 1 << record_day
+            total_minutes += get_duration_minutes(record[4])
+        except (ValueError, IndexError):
+            continue
 
     total_hours = total_minutes / 60.0
     total_hours_display = f"{int(total_hours):02d}:{int(total_minutes % 60):02d}"
     current_salary = total_hours * hourly_rate
 
-    business_days_so_far = 0
-    for day in range(1, current_jday + 1):
-        if jdatetime.date(current_jyear, current_jmonth, day).weekday() != 6:
-            business_days_so_far += 1
+    business_days_so_far = count_business_days_until(current_jyear, current_jmonth, current_jday)
             
     expected_salary = (business_days_so_far * 8) * hourly_rate
 
     projected_salary = 0
-    if len(worked_days) > 0:
-        avg_hours_per_day = total_hours / len(worked_days)
-        last_day_of_month = get_last_day_of_jalali_month(current_jyear, current_jmonth)
-        
-        total_business_days_in_month = 0
-        for day in range(1, last_day_of_month + 1):
-            if jdatetime.date(current_jyear, current_jmonth, day).weekday() != 6:
-                total_business_days_in_month += 1
-                
+    worked_days_count = worked_days_mask.bit_count()
+    if worked_days_count > 0:
+        avg_hours_per_day = total_hours / worked_days_count
+        total_business_days_in_month = count_business_days_in_jalali_month(current_jyear, current_jmonth)
         remaining_business_days = total_business_days_in_month - business_days_so_far
         projected_total_hours = total_hours + (avg_hours_per_day * remaining_business_days)
         projected_salary = projected_total_hours * hourly_rate
@@ -132,6 +381,97 @@ def calculate_monthly_stats(sheet, j_now, hourly_rate):
     }
 
 
+def get_cached_checkin_time(rows, row_number):
+    """Returns the check-in cell of a row from the cached rows, or None if it is not there."""
+    index = row_number - SheetCache.first_row
+    return rows[index][2] if 0 <= index < len(rows) and len(rows[index]) > 2 else None
+
+async def write_checkout(row_number, checkout_time, activity=None):
+    """Writes a session's check-out time, duration and activity (if given) in one batch_update call.
+
+    Returns the duration written, or None if it could not be computed.
+    """
+    checkin_time = get_cached_checkin_time(await sheet_cache.get_rows(), row_number)
+    duration = format_session_duration(checkin_time, checkout_time)
+    if duration is None:
+        # the cached copy may predate the check-in or a manual edit, so read the sheet once more
+        checkin_time = get_cached_checkin_time(await sheet_cache.get_rows(force=True), row_number)
+        duration = format_session_duration(checkin_time, checkout_time)
+
+    if duration is None:
+        logging.warning(f"Could not compute the duration of row {row_number}; writing the check-out time only.")
+        data = [{'range': f'D{row_number}', 'values': [[checkout_time]]}]
+        if activity:
+            data.append({'range': f'F{row_number}', 'values': [[activity]]})
+    elif activity:
+        data = [{'range': f'D{row_number}:F{row_number}', 'values': [[checkout_time, duration, activity]]}]
+    else:
+        data = [{'range': f'D{row_number}:E{row_number}', 'values': [[checkout_time, duration]]}]
+    # USER_ENTERED stores the duration as a time value (not text) so sheet formulas can sum column E;
+    # it reads back as a day fraction, which get_duration_minutes handles
+    await sheet_call(worksheet.batch_update, data, value_input_option='USER_ENTERED')
+
+    if duration is None:
+        sheet_cache.invalidate()
+    else:
+        sheet_cache.set_cells(row_number, 4, [checkout_time, duration])
+    return duration
+
+
+def format_stats_message(stats, month_name):
+    """Formats the monthly stats as a Markdown message."""
+    return STATS_MESSAGE_TEMPLATE.safe_substitute(
+        month=month_name,
+        total_hours=stats['total_hours'],
+        current_salary=f"{stats['current_salary']:,}",
+        expected_salary=f"{stats['expected_salary']:,}",
+        projected_salary=f"{stats['projected_salary']:,}",
+    )
+
+last_stats_message = None
+background_tasks = set()
+
+async def build_stats_message():
+    """Builds the current month's stats message from the cached sheet rows."""
+    global last_stats_message
+    jnow = jdatetime.datetime.now()
+    records = await sheet_cache.get_month_rows(jnow.year, jnow.month)
+    stats = calculate_monthly_stats(records, jnow, HOURLY_RATE)
+    last_stats_message = format_stats_message(stats, jnow.strftime("%B"))
+    return last_stats_message
+
+async def refresh_stats_message(sent_message, shown_text):
+    """Recomputes the stats and edits an already sent message only if the text changed."""
+    try:
+        text = await build_stats_message()
+        if text != shown_text:
+            await sent_message.edit_text(text)
+    except Exception as e:
+        logging.error(f"Error in refresh_stats_message: {e}", exc_info=True)
+
+
+pending_checkouts = {}
+
+async def flush_checkout_after_timeout(chat_id, state, row_number, checkout_time):
+    """Writes the check-out time on its own if no activity arrives in time."""
+    await asyncio.sleep(ACTIVITY_TIMEOUT)
+    try:
+        await write_checkout(row_number, checkout_time)
+        # only clear the state if it still belongs to this check-out and not to a newer one
+        data = await state.get_data()
+        if data.get("row_number") == row_number and data.get("checkout_time") == checkout_time:
+            await state.clear()
+        logging.info(f"No activity received for row {row_number}; check-out time written on its own.")
+    except Exception as e:
+        logging.error(f"Error in flush_checkout_after_timeout: {e}", exc_info=True)
+        # handle_check_out already closed the row in the cache; undo that since the write failed
+        sheet_cache.invalidate()
+        sheet_cache.open_checkin_row = row_number
+    finally:
+        if pending_checkouts.get(chat_id) is asyncio.current_task():
+            del pending_checkouts[chat_id]
+
+
 class ActivityState(StatesGroup):
     waiting_for_activity = State()
 
@@ -152,61 +492,73 @@ async def cmd_start(message: types.Message):
 
 @router.message(Command("stats"))
 async def cmd_stats(message: types.Message):
-    await message.answer("Calculating monthly stats... please wait.")
     try:
-        jnow = jdatetime.datetime.now()
-        month_name = jnow.strftime("%B")
-        stats = calculate_monthly_stats(worksheet, jnow, HOURLY_RATE)
-        
-        stats_message = (
-            f"📊 **stats of {month_name}**\n\n"
-            f"🕒 **total hours:** `{stats['total_hours']}`\n"
-            f"💵 **current salary:** `{stats['current_salary']:,} TMN`\n\n"
-            f"📈 **expected salary(8 hours a day):** `{stats['expected_salary']:,} TMN`\n"
-            f"🔮 **projected salary:** `{stats['projected_salary']:,} TMN`"
-        )
-        await message.answer(stats_message)
+        shown_text = last_stats_message
+        if shown_text is None:
+            await message.answer(await build_stats_message())
+            return
+        # reply with the last known stats right away and correct them in place if they changed
+        sent_message = await message.answer(shown_text)
+        task = asyncio.create_task(refresh_stats_message(sent_message, shown_text))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
     except Exception as e:
         logging.error(f"Error in cmd_stats: {e}", exc_info=True)
         await message.answer("An error occurred while fetching stats.")
 
 @router.message(F.text == "⏰ Check In")
 async def handle_check_in(message: types.Message):
-    try:
-        row_to_update = find_first_empty_row(worksheet)
-        date_str, time_str, weekday_str = get_current_jalali_datetime()
-        
-        new_row_data = [date_str, weekday_str, time_str]
-        worksheet.update(f'A{row_to_update}:C{row_to_update}', [new_row_data])
-        
-        await message.answer(f"✅ Check-in recorded at {time_str}.")
-    except Exception as e:
-        logging.error(f"Error in handle_check_in: {e}", exc_info=True)
+    date_str, time_str, weekday_str = get_current_jalali_datetime()
+    
+    new_row_data = [date_str, weekday_str, time_str]
+    # appending to the A:C table returns the written range, so no read is needed to find the row;
+    # the reply is sent while the write is in flight, and the two results are checked separately
+    response, reply = await asyncio.gather(
+        non_idempotent_sheet_call(worksheet.append_row, new_row_data, table_range='A:C'),
+        message.answer(f"✅ Check-in recorded at {time_str}."),
+        return_exceptions=True,
+    )
+    if isinstance(reply, BaseException):
+        logging.error(f"Failed to send the check-in confirmation: {reply}", exc_info=reply)
+    if isinstance(response, BaseException):
+        logging.error(f"Error in handle_check_in: {response}", exc_info=response)
         await message.answer("Failed to record check-in. Please check the connection with Google Sheets.")
+        return
+
+    row_number = get_first_row_of_range(response['updates']['updatedRange'])
+    sheet_cache.set_cells(row_number, 1, new_row_data)
+    sheet_cache.open_checkin_row = row_number
 
 @router.message(F.text == "🏁 Check Out")
 async def handle_check_out(message: types.Message, state: FSMContext):
     try:
-        all_records = worksheet.get_all_values()
-        row_to_update_index = -1
-        
-        for i in range(len(all_records) - 1, 0, -1):
-            row = all_records[i]
-            if len(row) > 2 and row[2] and (len(row) < 4 or not row[3]):
-                row_to_update_index = i
-                break
+        if await state.get_state() == ActivityState.waiting_for_activity.state:
+            await message.answer("⚠️ You have already checked out. Please enter your activity (or type `skip`).")
+            return
+
+        row_number = sheet_cache.open_checkin_row
+        if row_number is None:
+            # e.g. after a restart: fall back to scanning the cached rows
+            row_number = find_open_row(await sheet_cache.get_rows())
                 
-        if row_to_update_index == -1:
+        if row_number is None:
             await message.answer("⚠️ You need to check in first!")
             return
             
-        row_number = row_to_update_index + 1
         _, time_str, _ = get_current_jalali_datetime()
 
-        worksheet.update_cell(row_number, 4, time_str)
-        
-        await state.update_data(row_number=row_number)
+        # the check-out time is written together with the activity in process_activity
+        await state.update_data(row_number=row_number, checkout_time=time_str)
         await state.set_state(ActivityState.waiting_for_activity)
+        sheet_cache.open_checkin_row = None
+        # the sheet write is deferred, so close the row in the cache now to keep find_open_row from returning it
+        sheet_cache.set_cells(row_number, 4, [time_str])
+        previous_checkout = pending_checkouts.pop(message.chat.id, None)
+        if previous_checkout:
+            previous_checkout.cancel()
+        pending_checkouts[message.chat.id] = asyncio.create_task(
+            flush_checkout_after_timeout(message.chat.id, state, row_number, time_str)
+        )
         await message.answer(f"✅ Check-out recorded at {time_str}.\n\nPlease enter your activity for this session (or type `skip`).")
     except Exception as e:
         logging.error(f"Error in handle_check_out: {e}", exc_info=True)
@@ -215,37 +567,100 @@ async def handle_check_out(message: types.Message, state: FSMContext):
 
 @router.message(ActivityState.waiting_for_activity)
 async def process_activity(message: types.Message, state: FSMContext):
+    pending_checkout = pending_checkouts.pop(message.chat.id, None)
+    if pending_checkout:
+        pending_checkout.cancel()
+
     data = await state.get_data()
     row_number = data.get("row_number")
+    checkout_time = data.get("checkout_time")
     
     activity = message.text
-    if activity and activity.lower().strip() != 'skip':
-        worksheet.update_cell(row_number, 6, activity)
-        await message.answer("✅ Activity recorded.", reply_markup=main_keyboard)
-    else:
-        await message.answer("👍 Activity skipped.", reply_markup=main_keyboard)
+    if activity and activity.lower().strip() == 'skip':
+        activity = None
+    try:
+        duration = await write_checkout(row_number, checkout_time, activity)
+    except Exception as e:
+        logging.error(f"Error in process_activity: {e}", exc_info=True)
+        sheet_cache.invalidate()
+        sheet_cache.open_checkin_row = row_number
+        await message.answer("Failed to record check-out. Please check the connection with Google Sheets.", reply_markup=main_keyboard)
+        await state.clear()
+        return
 
     await state.clear()
-    await cmd_stats(message)
+    # the confirmation and the updated stats go out as one message
+    reply = "✅ Activity recorded." if activity else "👍 Activity skipped."
+    if duration is None:
+        reply += f"\n⚠️ Could not read the check-in time of row {row_number}, so the session duration was not recorded. Please fill in column E by hand."
+    try:
+        reply += "\n\n" + await build_stats_message()
+    except Exception as e:
+        logging.error(f"Error while building stats in process_activity: {e}", exc_info=True)
+    await message.answer(reply, reply_markup=main_keyboard)
+
+
+async def refresh_credentials_periodically():
+    """Refreshes the Google access token ahead of its one-hour expiry, off the request path."""
+    while True:
+        await asyncio.sleep(CREDENTIALS_REFRESH_INTERVAL)
+        try:
+            await asyncio.to_thread(credentials.refresh, Request())
+            logging.info("Refreshed Google credentials.")
+        except Exception as e:
+            logging.error(f"Failed to refresh Google credentials: {e}", exc_info=True)
+
+
+async def run_webhook(bot, dp):
+    """Serves updates through an aiohttp webhook endpoint until cancelled."""
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    logging.info(f"Setting webhook to {WEBHOOK_URL}{WEBHOOK_PATH}...")
+    await bot.set_webhook(f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET, drop_pending_updates=True)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, WEBAPP_HOST, WEBAPP_PORT)
+    await site.start()
+    logging.info(f">>> Webhook server is listening on {WEBAPP_HOST}:{WEBAPP_PORT}...")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
 
 
 async def main():
     logging.info("Setting up Bot and Dispatcher...")
+    asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=THREAD_POOL_WORKERS))
+    credentials_refresh_task = asyncio.create_task(refresh_credentials_periodically())
+    try:
+        bot = Bot(
+            token=BOT_TOKEN, 
+            default=DefaultBotProperties(parse_mode=ParseMode.MARKDOWN)
+        )
+        bot.session.middleware(RateLimitMiddleware(tg_limiter))
     
-    bot = Bot(
-        token=BOT_TOKEN, 
-        default=DefaultBotProperties(parse_mode='Markdown')
-    )
-    
-    storage = MemoryStorage()
-    dp = Dispatcher(storage=storage)
-    dp.include_router(router)
+        if REDIS_URL:
+            logging.info("Using Redis for FSM storage.")
+            storage = RedisStorage(redis=Redis.from_url(REDIS_URL, max_connections=REDIS_MAX_CONNECTIONS))
+        else:
+            storage = MemoryStorage()
+        dp = Dispatcher(storage=storage)
+        dp.include_router(router)
     
-    logging.info("Deleting any existing webhook...")
-    await bot.delete_webhook(drop_pending_updates=True)
+        if WEBHOOK_URL:
+            await run_webhook(bot, dp)
+            return
+
+        logging.info("Deleting any existing webhook...")
+        await bot.delete_webhook(drop_pending_updates=True)
     
-    logging.info(">>> Bot polling is starting now...")
-    await dp.start_polling(bot)
+        logging.info(">>> Bot polling is starting now...")
+        await dp.start_polling(bot)
+    finally:
+        credentials_refresh_task.cancel()
 
 if __name__ == "__main__":
     logging.info("Attempting to run the bot...")